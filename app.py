@@ -1,46 +1,188 @@
 import os
+import atexit
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
 import re
+import math
 import time
+import random
+import itertools
+import heapq
 import threading
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import Future
+import orjson
 from flask import Flask, render_template, request, jsonify, redirect, url_for, session
+from flask.json.provider import JSONProvider
+from werkzeug.middleware.proxy_fix import ProxyFix
 from curl_cffi.requests import Session, errors
 from dotenv import load_dotenv
 import database as db
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+
+def _setup_logging():
+    """日志经队列交给后台线程输出，请求线程不直接写 stdout"""
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('[%(asctime)s] [%(levelname)s] %(message)s'))
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+    logger.propagate = False
+
+
+_setup_logging()
+
+
+class OrjsonProvider(JSONProvider):
+    """使用 orjson 处理 request.json 与 jsonify"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.secret_key = os.getenv('SECRET_KEY', 'sora-studio-pro-secret-key-2024')
 
+# 部署在反向代理之后时，按 X-Forwarded-For 还原客户端 IP（限流按 IP 计数）
+_TRUSTED_PROXY_COUNT = int(os.getenv('TRUSTED_PROXY_COUNT', '0'))
+if _TRUSTED_PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=_TRUSTED_PROXY_COUNT)
+
 # 配置
 APP_ACCESS_TOKEN = os.getenv('APP_ACCESS_TOKEN')
 ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', 'admin123')
-
-# 轮询索引
-account_index = 0
-proxy_index = 0
-index_lock = threading.Lock()
-
-
-# 缓存
+_AUTH_REQUIRED = bool(APP_ACCESS_TOKEN)
+
+# 分享链接形如 https://sora.chatgpt.com/p/<video_id>：先用子串定位，
+# 再从该位置锚定匹配 ID，不对整段输入做正则扫描
+_SORA_URL_MARKER = 'sora.chatgpt.com/p/'
+_SORA_ID_RE = re.compile(r'[a-zA-Z0-9_]+')
+
+_BASE_SORA_HEADERS = {
+    'Accept': 'application/json',
+    'Accept-Encoding': 'gzip',
+    'oai-package-name': 'com.openai.sora',
+    'User-Agent': 'Sora/1.2025.308'
+}
+
+# 缓存：管理接口写入时主动失效，但只作用于处理该请求的进程；
+# 其他 worker 依靠较短的 TTL 在数十秒内看到后台修改
+# 过期时间基于 time.monotonic()，不受系统时间跳变影响
+_CACHE_TTL = 20
 _settings_cache = {'data': None, 'expires': 0}
 _accounts_cache = {'data': None, 'expires': 0}
 _proxies_cache = {'data': None, 'expires': 0}
 
+# 缓存过期时只允许一个线程回源数据库，其余线程等待后复用结果
+_settings_lock = threading.Lock()
+_accounts_lock = threading.Lock()
+_proxies_lock = threading.Lock()
+
 _thread_local = threading.local()
-_SESSION_CACHE_MAX = 20
 
+# HTTP 会话进程内共享（curl_cffi Session 为每个线程维护独立的 curl 句柄），
+# 按最近使用顺序排列，超出上限时淘汰最久未用的会话
+_SESSIONS = OrderedDict()
+_SESSIONS_LOCK = threading.Lock()
+_SESSION_CACHE_MAX = 256
+# 最近使用时间单独存放，供空闲清理使用；超过空闲时间的会话移出池，引用释放后连接随之关闭
+_SESSION_LAST_USED = {}
+_SESSION_IDLE_TIMEOUT = 120
 
-def get_settings():
-    """获取所有设置（带缓存，30秒TTL）"""
-    now = time.time()
-    if _settings_cache['data'] is not None and now < _settings_cache['expires']:
-        return _settings_cache['data']
-    
-    settings = db.get_all_settings()
-    _settings_cache['data'] = settings
-    _settings_cache['expires'] = now + 30
-    return settings
+# 轮询计数器按线程独立，避免所有请求争用同一把锁；
+# 每个线程首次使用时从全局序列取起点，错开各线程的轮询位置
+_thread_seed = itertools.count()
+
+
+def _jitter(base):
+    """为缓存 TTL 加入 ±20% 随机抖动，避免多个缓存同时过期回源"""
+    return base * random.uniform(0.8, 1.2)
+
+
+def _next_counter(name):
+    """返回当前线程的轮询计数并自增"""
+    ctr = getattr(_thread_local, name, None)
+    if ctr is None:
+        ctr = next(_thread_seed)
+    setattr(_thread_local, name, ctr + 1)
+    return ctr
+
+
+# 熔断：连续失败达到阈值的代理/账号冷却一段时间，期间轮询跳过
+_BREAKER_THRESHOLD = 3
+_BREAKER_COOLDOWN = 60
+_breaker_fails = {}
+_breaker_open_until = {}
+
+
+def _breaker_record(key, ok):
+    """记录一次结果，key 形如 ('proxy', id) / ('account', id)"""
+    if ok:
+        if key in _breaker_fails:
+            _breaker_fails.pop(key, None)
+            _breaker_open_until.pop(key, None)
+        return
+    fails = _breaker_fails.get(key, 0) + 1
+    _breaker_fails[key] = fails
+    # 冷却结束后计数不清零，再失败一次即重新熔断
+    if fails >= _BREAKER_THRESHOLD:
+        _breaker_open_until[key] = time.monotonic() + _BREAKER_COOLDOWN
+
+
+def _breaker_open(key):
+    until = _breaker_open_until.get(key)
+    return until is not None and time.monotonic() < until
+
+
+def _int_setting(settings, key, default):
+    """解析整数设置，值非法（如 '1.5'、任意字符串）或非正数时使用默认值"""
+    try:
+        value = int(settings.get(key))
+    except (TypeError, ValueError):
+        return default
+    return value if value > 0 else default
+
+
+def _parse_settings(settings):
+    """把字符串设置解析为请求路径直接使用的 int/bool"""
+    return {
+        'max_retries': int(settings.get('max_retries', '3')),
+        'retry_delay': int(settings.get('retry_delay', '2')),
+        'retry_on_429': settings.get('retry_on_429') == '1',
+        'retry_on_403': settings.get('retry_on_403') == '1',
+        'proxy_enabled': settings.get('proxy_enabled') == '1',
+        'proxy_pool_enabled': settings.get('proxy_pool_enabled') == '1',
+        'rate_limit': _int_setting(settings, 'rate_limit', 0),
+        'rate_limit_window': _int_setting(settings, 'rate_limit_window', 60),
+    }
+
+
+def get_typed_settings():
+    """获取解析后的设置（带缓存，写入时失效），过期时回源数据库"""
+    typed = _settings_cache['data']
+    if typed is not None and time.monotonic() < _settings_cache['expires']:
+        return typed
+
+    with _settings_lock:
+        now = time.monotonic()
+        typed = _settings_cache['data']
+        if typed is None or now >= _settings_cache['expires']:
+            typed = _parse_settings(db.get_all_settings())
+            _settings_cache['data'] = typed
+            _settings_cache['expires'] = now + _jitter(_CACHE_TTL)
+    return typed
 
 
 def invalidate_settings_cache():
@@ -50,22 +192,25 @@ def invalidate_settings_cache():
 
 
 def get_next_account():
-    """轮询获取下一个可用账号（带缓存，10秒TTL）"""
-    global account_index
-    now = time.time()
-    
+    """轮询获取下一个可用账号（带缓存，写入时失效）"""
     # 使用缓存的账号列表
-    if _accounts_cache['data'] is None or now >= _accounts_cache['expires']:
-        _accounts_cache['data'] = db.get_enabled_accounts()
-        _accounts_cache['expires'] = now + 10
-    
     accounts = _accounts_cache['data']
+    if accounts is None or time.monotonic() >= _accounts_cache['expires']:
+        with _accounts_lock:
+            now = time.monotonic()
+            accounts = _accounts_cache['data']
+            if accounts is None or now >= _accounts_cache['expires']:
+                accounts = db.get_enabled_accounts()
+                _accounts_cache['data'] = accounts
+                _accounts_cache['expires'] = now + _jitter(_CACHE_TTL)
+
     if not accounts:
         return None
-    with index_lock:
-        account_index = account_index % len(accounts)
-        account = accounts[account_index]
-        account_index += 1
+    for _ in range(len(accounts)):
+        account = accounts[_next_counter('acct_ctr') % len(accounts)]
+        if not _breaker_open(('account', account['id'])):
+            return account
+    # 全部熔断时仍按轮询结果返回
     return account
 
 
@@ -81,74 +226,197 @@ def invalidate_proxies_cache():
     _proxies_cache['expires'] = 0
 
 
-def _get_cached_proxies():
-    now = time.time()
-    if _proxies_cache['data'] is None or now >= _proxies_cache['expires']:
-        _proxies_cache['data'] = db.get_enabled_proxies()
-        _proxies_cache['expires'] = now + 10
-    return _proxies_cache['data']
+_STRIDE_MAX_WEIGHT = 10
 
 
-def _trim_sessions(sessions):
-    overflow = len(sessions) - _SESSION_CACHE_MAX
-    if overflow <= 0:
-        return
-    oldest = sorted(sessions.items(), key=lambda item: item[1]['last_used'])[:overflow]
-    for key, info in oldest:
+def _build_stride_seq(proxies):
+    """按成功率（拉普拉斯平滑）加权，预先展开为交错的轮询序列"""
+    weights = []
+    for p in proxies:
+        ok, fail = p.get('success_count') or 0, p.get('fail_count') or 0
+        rate = (ok + 1) / (ok + fail + 2)
+        weights.append(max(1, round(rate * _STRIDE_MAX_WEIGHT)))
+
+    # 静态 stride 调度：每次选截止时间最早的代理，再按 1/weight 推后
+    heap = [(1 / w, i) for i, w in enumerate(weights)]
+    heapq.heapify(heap)
+    seq = []
+    for _ in range(sum(weights)):
+        deadline, i = heap[0]
+        seq.append(proxies[i])
+        heapq.heapreplace(heap, (deadline + 1 / weights[i], i))
+    return seq
+
+
+def _get_cached_proxies():
+    """返回启用代理的加权轮询序列"""
+    seq = _proxies_cache['data']
+    if seq is not None and time.monotonic() < _proxies_cache['expires']:
+        return seq
+
+    with _proxies_lock:
+        now = time.monotonic()
+        seq = _proxies_cache['data']
+        if seq is None or now >= _proxies_cache['expires']:
+            seq = _build_stride_seq(db.get_enabled_proxies())
+            _proxies_cache['data'] = seq
+            _proxies_cache['expires'] = now + _jitter(_CACHE_TTL)
+    return seq
+
+
+# 请求结果（使用统计与日志）交给后台线程批量写库，不占用响应时间
+_DB_WRITE_Q = queue.Queue()
+_DB_WRITE_BATCH = 100
+
+
+def _db_writer():
+    while True:
+        batch = [_DB_WRITE_Q.get()]
+        while len(batch) < _DB_WRITE_BATCH:
+            try:
+                batch.append(_DB_WRITE_Q.get_nowait())
+            except queue.Empty:
+                break
         try:
-            info['session'].close()
-        except Exception:
-            pass
-        sessions.pop(key, None)
+            db.record_request_results(batch)
+        except Exception as e:
+            logger.error("db_writer 写入失败: %s", e)
+        finally:
+            for _ in batch:
+                _DB_WRITE_Q.task_done()
+
+
+threading.Thread(target=_db_writer, name='db-writer', daemon=True).start()
+# 退出前等待队列中的结果写完
+atexit.register(_DB_WRITE_Q.join)
+
+
+def record_request_result(account, proxy, video_id, success, error_msg=None):
+    """异步记录一次请求结果"""
+    proxy_id, proxy_url = (proxy['id'], proxy['proxy_url']) if proxy else (None, None)
+    _DB_WRITE_Q.put((account['id'], account['name'], proxy_id, proxy_url, video_id, success, error_msg))
+
+
+# 按客户端 IP 的滑动窗口限流：ip -> 窗口内的请求时间；计数按进程独立
+_RATE_HITS = defaultdict(deque)
+_RATE_LOCK = threading.Lock()
+_RATE_PURGE_INTERVAL = 60
+_rate_next_purge = 0
+
+
+def _rate_limit_wait(ip, limit, window):
+    """超出限额时返回需等待的秒数，否则记录本次请求并返回 0"""
+    global _rate_next_purge
+    now = time.monotonic()
+    cutoff = now - window
+    with _RATE_LOCK:
+        if now >= _rate_next_purge:
+            # 定期清理窗口内已无请求的客户端，防止字典无限增长
+            _rate_next_purge = now + _RATE_PURGE_INTERVAL
+            for key in [k for k, v in _RATE_HITS.items() if not v or v[-1] <= cutoff]:
+                del _RATE_HITS[key]
+        hits = _RATE_HITS[ip]
+        while hits and hits[0] <= cutoff:
+            hits.popleft()
+        if len(hits) >= limit:
+            return int(hits[0] - cutoff) + 1
+        hits.append(now)
+    return 0
+
+
+# 正在进行中的视频解析：video_id -> Future
+_INFLIGHT = {}
+_INFLIGHT_LOCK = threading.Lock()
 
 
 def get_http_session(proxy=None):
     proxy_url = proxy.get('proxy_url') if isinstance(proxy, dict) else proxy
     key = proxy_url or 'direct'
-    sessions = getattr(_thread_local, 'sessions', None)
-    if sessions is None:
-        sessions = {}
-        _thread_local.sessions = sessions
-
-    entry = sessions.get(key)
-    if entry:
-        entry['last_used'] = time.time()
-        return entry['session']
-
-    proxies = {}
-    if proxy_url:
-        proxies = {"http": proxy_url, "https": proxy_url}
-
-    sess = Session(impersonate="chrome110", proxies=proxies)
-    sessions[key] = {'session': sess, 'last_used': time.time()}
-    _trim_sessions(sessions)
+
+    sess = _SESSIONS.get(key)
+    if sess is not None:
+        _SESSION_LAST_USED[key] = time.monotonic()
+        try:
+            _SESSIONS.move_to_end(key)
+        except KeyError:
+            # 刚被其他线程淘汰，本次仍可继续使用
+            pass
+        return sess
+
+    with _SESSIONS_LOCK:
+        sess = _SESSIONS.get(key)
+        if sess is not None:
+            return sess
+
+        proxies = {}
+        if proxy_url:
+            proxies = {"http": proxy_url, "https": proxy_url}
+
+        sess = Session(impersonate="chrome110", proxies=proxies)
+        _SESSIONS[key] = sess
+        _SESSION_LAST_USED[key] = time.monotonic()
+        if len(_SESSIONS) > _SESSION_CACHE_MAX:
+            old_key, _ = _SESSIONS.popitem(last=False)
+            _SESSION_LAST_USED.pop(old_key, None)
     return sess
 
 
-def get_next_proxy():
-    """轮询获取下一个可用代理"""
-    global proxy_index
-    settings = get_settings()
-    
+def _drop_sessions(keys):
+    """从会话池移除指定会话
+
+    不调用 close()：它只关闭当前线程的 curl 句柄，还会让仍持有该会话的请求线程
+    收到 SessionClosed。移出池后，最后一个引用释放时各线程的句柄随之回收。
+    """
+    with _SESSIONS_LOCK:
+        for key in keys:
+            _SESSIONS.pop(key, None)
+            _SESSION_LAST_USED.pop(key, None)
+
+
+def evict_stale_sessions():
+    """移除已删除或已禁用代理对应的会话"""
+    keep = {p['proxy_url'] for p in db.get_enabled_proxies()}
+    # 命中路径会无锁调整顺序，先取快照再遍历
+    _drop_sessions([key for key in list(_SESSIONS) if key != 'direct' and key not in keep])
+
+
+def _sweep_idle_sessions():
+    cutoff = time.monotonic() - _SESSION_IDLE_TIMEOUT
+    _drop_sessions([key for key in list(_SESSIONS) if _SESSION_LAST_USED.get(key, 0) < cutoff])
+
+
+def _session_sweeper():
+    while True:
+        time.sleep(_SESSION_IDLE_TIMEOUT / 2)
+        _sweep_idle_sessions()
+
+
+threading.Thread(target=_session_sweeper, name='session-sweeper', daemon=True).start()
+
+
+def get_next_proxy(settings, skip=None):
+    """轮询获取下一个可用代理，跳过 skip 中已尝试过的代理 id"""
     # 检查是否启用代理
-    if settings.get('proxy_enabled') != '1':
+    if not settings['proxy_enabled']:
         return None
     
     # 检查是否启用代理池
-    if settings.get('proxy_pool_enabled') == '1':
-        proxies = _get_cached_proxies()
-        if proxies:
-            with index_lock:
-                proxy_index = proxy_index % len(proxies)
-                proxy = proxies[proxy_index]
-                proxy_index += 1
+    if settings['proxy_pool_enabled']:
+        seq = _get_cached_proxies()
+        if seq:
+            # 每次尝试都推进计数，避免跳过的代理把流量集中到相邻代理上
+            for _ in range(len(seq)):
+                proxy = seq[_next_counter('proxy_ctr') % len(seq)]
+                if (not skip or proxy['id'] not in skip) and not _breaker_open(('proxy', proxy['id'])):
+                    return proxy
+            # 全部已尝试或熔断，按轮询结果复用
             return proxy
     
     return None
 
 
 def refresh_token(account, proxy=None):
-    """刷新账号的 access_token"""
+    """刷新账号的 access_token，返回新 token，由 refresh_account_tokens 负责落库"""
     sess = get_http_session(proxy)
     url = "https://auth.openai.com/oauth/token"
     payload = {
@@ -160,99 +428,173 @@ def refresh_token(account, proxy=None):
     
     response = sess.post(url, json=payload, timeout=20)
     response.raise_for_status()
-    data = response.json()
-    
-    db.update_account_usage(
-        account['id'], 
-        success=True,
-        new_access_token=data['access_token'],
-        new_refresh_token=data['refresh_token']
-    )
-    
+    data = orjson.loads(response.content)
     return data['access_token'], data['refresh_token']
 
 
+# 同一账号的并发 token 刷新只发起一次：account_id -> Future
+_REFRESHING = {}
+_REFRESHING_LOCK = threading.Lock()
+
+
+def refresh_account_tokens(account, proxy=None):
+    """刷新账号 token，原地更新并立即落库；并发刷新同一账号时复用同一次结果"""
+    with _REFRESHING_LOCK:
+        future = _REFRESHING.get(account['id'])
+        is_leader = future is None
+        if is_leader:
+            future = Future()
+            _REFRESHING[account['id']] = future
+
+    if is_leader:
+        try:
+            tokens = refresh_token(account, proxy)
+            # refresh_token 已轮换，旧值失效，不走异步队列，立即落库
+            db.update_account_tokens(account['id'], *tokens)
+            future.set_result(tokens)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with _REFRESHING_LOCK:
+                _REFRESHING.pop(account['id'], None)
+
+    tokens = future.result()
+    # account 即账号缓存中的字典，原地更新后其他请求直接使用新 token
+    # 请求头缓存按 token 校验，换 token 后自动重建，无需单独清除
+    account['access_token'], account['refresh_token'] = tokens
+
+
+def _sora_headers(account):
+    """账号的请求头缓存在账号字典上，以 (token, headers) 保存，token 变化时重建"""
+    token = account['access_token']
+    cached = account.get('_sora_headers')
+    if cached is None or cached[0] != token:
+        cached = (token, _BASE_SORA_HEADERS | {'authorization': f'Bearer {token}'})
+        account['_sora_headers'] = cached
+    return cached[1]
+
+
 def make_sora_api_call(video_id, account, proxy=None):
     """执行 Sora API 请求"""
     sess = get_http_session(proxy)
     api_url = f"https://sora.chatgpt.com/backend/project_y/post/{video_id}"
     
-    headers = {
-        'Accept': 'application/json',
-        'Accept-Encoding': 'gzip',
-        'oai-package-name': 'com.openai.sora',
-        'authorization': f'Bearer {account["access_token"]}',
-        'User-Agent': 'Sora/1.2025.308'
-    }
-    
-    response = sess.get(api_url, headers=headers, timeout=20)
-    response.raise_for_status()
-    return response.json()
+    return sess.get(api_url, headers=_sora_headers(account), timeout=20)
+
+
+_MAX_RETRY_DELAY = 30
+
+
+def _retry_wait(response, retry_delay, attempt):
+    """重试等待秒数：优先遵循 Retry-After，否则指数退避并加随机抖动，上限 30 秒"""
+    retry_after = response.headers.get('Retry-After')
+    if retry_after:
+        try:
+            seconds = float(retry_after)
+        except ValueError:
+            # HTTP-date 格式不解析，退回指数退避
+            seconds = None
+        # nan/inf 也能被 float() 解析，需排除
+        if seconds is not None and math.isfinite(seconds):
+            return min(max(seconds, 0), _MAX_RETRY_DELAY)
+    return min(retry_delay * (2 ** attempt) * (1 + random.random() * 0.5), _MAX_RETRY_DELAY)
 
 
-def process_sora_request(video_id, account, proxy, proxy_id):
+def process_sora_request(video_id, account, proxy, proxy_id, settings):
     """处理 Sora 请求，包含重试逻辑"""
-    settings = get_settings()
-    max_retries = int(settings.get('max_retries', '3'))
-    retry_delay = int(settings.get('retry_delay', '2'))
-    retry_on_429 = settings.get('retry_on_429') == '1'
-    retry_on_403 = settings.get('retry_on_403') == '1'
+    max_retries = settings['max_retries']
+    retry_delay = settings['retry_delay']
+    retry_on_429 = settings['retry_on_429']
+    retry_on_403 = settings['retry_on_403']
     
     last_error = None
+    tried_proxies = {proxy_id} if proxy_id else set()
+    # 熔断计数：同一请求内每个代理/账号最多记一次失败，重试不重复累计
+    charged = set()
+
+    def charge(key):
+        if key not in charged:
+            charged.add(key)
+            _breaker_record(key, False)
     
     for attempt in range(max_retries + 1):
+        access_token = account['access_token']
         try:
-            response_data = make_sora_api_call(video_id, account, proxy)
-            download_link = response_data['post']['attachments'][0]['encodings']['source']['path']
-            return {'success': True, 'download_link': download_link}
-            
+            response = make_sora_api_call(video_id, account, proxy)
         except errors.RequestsError as e:
+            # 超时、连接失败等传输层错误
+            if proxy_id:
+                charge(('proxy', proxy_id))
             last_error = str(e)
-            status_code = e.response.status_code if e.response else None
-            
-            # 429 Too Many Requests
-            if status_code == 429 and retry_on_429:
-                print(f"[429] attempt {attempt + 1}/{max_retries + 1}")
-                if attempt < max_retries:
-                    # 切换代理并重试
-                    proxy = get_next_proxy()
-                    proxy_id = proxy['id'] if proxy else None
-                    time.sleep(retry_delay * (attempt + 1))
-                    continue
-            
-            # 403 Forbidden
-            if status_code == 403 and retry_on_403:
-                print(f"[403] attempt {attempt + 1}/{max_retries + 1}")
-                if attempt < max_retries:
-                    time.sleep(retry_delay)
-                    continue
-            
-            # 401 尝试刷新 token
-            if status_code == 401:
-                try:
-                    new_access, new_refresh = refresh_token(account, proxy)
-                    account['access_token'] = new_access
-                    continue
-                except Exception as refresh_error:
-                    last_error = f"Token 刷新失败: {refresh_error}"
-            
-            break
-            
-        except (KeyError, IndexError):
-            last_error = "无法从API响应中找到下载链接"
             break
         except Exception as e:
             last_error = str(e)
             break
+        status_code = response.status_code
+        
+        if response.ok:
+            _breaker_record(('account', account['id']), True)
+            if proxy_id:
+                _breaker_record(('proxy', proxy_id), True)
+            try:
+                response_data = orjson.loads(response.content)
+                attachments = (response_data.get('post') or {}).get('attachments') or [{}]
+                download_link = ((attachments[0].get('encodings') or {}).get('source') or {}).get('path')
+            except (orjson.JSONDecodeError, AttributeError, TypeError, KeyError, IndexError):
+                # 响应体不是预期结构，不计入熔断
+                download_link = None
+            if not download_link:
+                last_error = "无法从API响应中找到下载链接"
+                break
+            return {'success': True, 'download_link': download_link, 'proxy': proxy}
+        
+        # 429/403/401 属于预期的流控信号，按状态码分支处理而不抛异常
+        last_error = f"HTTP Error {status_code}: {response.reason}"
+        if status_code in (429, 403):
+            # 有代理时归咎于出口 IP，直连时归咎于账号
+            charge(('proxy', proxy_id) if proxy_id else ('account', account['id']))
+        
+        # 429 Too Many Requests
+        if status_code == 429 and retry_on_429:
+            logger.debug("[429] attempt %d/%d", attempt + 1, max_retries + 1)
+            if attempt < max_retries:
+                # 切换代理并重试
+                proxy = get_next_proxy(settings, skip=tried_proxies)
+                proxy_id = proxy['id'] if proxy else None
+                if proxy_id:
+                    tried_proxies.add(proxy_id)
+                time.sleep(_retry_wait(response, retry_delay, attempt))
+                continue
+        
+        # 403 Forbidden
+        if status_code == 403 and retry_on_403:
+            logger.debug("[403] attempt %d/%d", attempt + 1, max_retries + 1)
+            if attempt < max_retries:
+                time.sleep(_retry_wait(response, retry_delay, attempt))
+                continue
+        
+        # 401 尝试刷新 token
+        if status_code == 401:
+            # 其他请求已在此期间刷新过，直接用新 token 重试
+            if account['access_token'] != access_token:
+                continue
+            try:
+                refresh_account_tokens(account, proxy)
+                continue
+            except Exception as refresh_error:
+                charge(('account', account['id']))
+                last_error = f"Token 刷新失败: {refresh_error}"
+        
+        break
     
-    return {'success': False, 'error': last_error, 'proxy_id': proxy_id}
+    return {'success': False, 'error': last_error, 'proxy': proxy}
 
 
 # ========== 页面路由 ==========
 @app.route('/')
 def index():
-    auth_required = APP_ACCESS_TOKEN is not None and APP_ACCESS_TOKEN != ""
-    return render_template('index.html', auth_required=auth_required)
+    return render_template('index.html', auth_required=_AUTH_REQUIRED)
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -280,42 +622,71 @@ def manage():
 
 
 # ========== API 路由 ==========
-@app.route('/get-sora-link', methods=['POST'])
-def get_sora_link():
+def resolve_sora_link(video_id, settings):
+    """解析视频下载链接，返回 (响应数据, 状态码)"""
     account = get_next_account()
     if not account:
-        return jsonify({"error": "没有可用的 Sora 账号，请在管理后台添加。"}), 500
+        return {"error": "没有可用的 Sora 账号，请在管理后台添加。"}, 500
+
+    proxy = get_next_proxy(settings)
+    proxy_id = proxy['id'] if proxy else None
+
+    result = process_sora_request(video_id, account, proxy, proxy_id, settings)
+    if result['success']:
+        record_request_result(account, result['proxy'], video_id, True)
+        return {"download_link": result['download_link']}, 200
+    else:
+        record_request_result(account, result['proxy'], video_id, False, result['error'])
+        return {"error": f"请求失败: {result['error']}"}, 500
 
-    if APP_ACCESS_TOKEN:
-        if request.json.get('token') != APP_ACCESS_TOKEN:
-            return jsonify({"error": "无效或缺失的访问令牌。"}), 401
 
-    sora_url = request.json.get('url')
+@app.route('/get-sora-link', methods=['POST'])
+def get_sora_link():
+    # 一次请求只取一次设置快照，向下传递
+    settings = get_typed_settings()
+    if settings['rate_limit'] > 0:
+        wait = _rate_limit_wait(request.remote_addr, settings['rate_limit'], settings['rate_limit_window'])
+        if wait:
+            return jsonify({"error": f"请求过于频繁，请 {wait} 秒后再试", "code": "agent.rate_limited"}), 429, {'Retry-After': str(wait)}
+
+    body = request.get_json(silent=True)
+    # 非 JSON 或非对象（数组、字符串等）的请求体按空请求处理
+    if not isinstance(body, dict):
+        body = {}
+    if _AUTH_REQUIRED and body.get('token') != APP_ACCESS_TOKEN:
+        return jsonify({"error": "无效或缺失的访问令牌。"}), 401
+
+    sora_url = body.get('url')
     if not sora_url:
         return jsonify({"error": "未提供 URL"}), 400
 
-    match = re.search(r'sora\.chatgpt\.com/p/([a-zA-Z0-9_]+)', sora_url)
+    pos = sora_url.find(_SORA_URL_MARKER)
+    match = _SORA_ID_RE.match(sora_url, pos + len(_SORA_URL_MARKER)) if pos >= 0 else None
     if not match:
         return jsonify({"error": "无效的 Sora 链接格式。请发布后复制分享链接"}), 400
 
-    video_id = match.group(1)
-    proxy = get_next_proxy()
-    proxy_id = proxy['id'] if proxy else None
+    video_id = match.group()
 
-    result = process_sora_request(video_id, account, proxy, proxy_id)
-    
-    if result['success']:
-        db.update_account_usage(account['id'], success=True)
-        if proxy_id:
-            db.update_proxy_usage(proxy_id, success=True)
-        db.add_log(account['id'], proxy_id, video_id, success=True)
-        return jsonify({"download_link": result['download_link']})
-    else:
-        db.update_account_usage(account['id'], success=False)
-        if result.get('proxy_id'):
-            db.update_proxy_usage(result['proxy_id'], success=False)
-        db.add_log(account['id'], result.get('proxy_id'), video_id, success=False, error_msg=result['error'])
-        return jsonify({"error": f"请求失败: {result['error']}"}), 500
+    # 同一视频的并发请求只向上游发起一次，其余请求等待并复用结果
+    with _INFLIGHT_LOCK:
+        future = _INFLIGHT.get(video_id)
+        is_leader = future is None
+        if is_leader:
+            future = Future()
+            _INFLIGHT[video_id] = future
+
+    if is_leader:
+        try:
+            future.set_result(resolve_sora_link(video_id, settings))
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with _INFLIGHT_LOCK:
+                _INFLIGHT.pop(video_id, None)
+
+    payload, status = future.result()
+    return jsonify(payload), status
 
 
 # ========== 管理 API ==========
@@ -399,6 +770,7 @@ def api_update_proxy(proxy_id):
     data = request.json
     db.update_proxy(proxy_id, **data)
     invalidate_proxies_cache()
+    evict_stale_sessions()
     return jsonify({"success": True})
 
 
@@ -407,6 +779,7 @@ def api_update_proxy(proxy_id):
 def api_delete_proxy(proxy_id):
     db.delete_proxy(proxy_id)
     invalidate_proxies_cache()
+    evict_stale_sessions()
     return jsonify({"success": True})
 
 
@@ -450,4 +823,5 @@ def api_get_stats():
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5001, debug=True)
+    # 开发服务器，仅用于本地调试；生产环境见 gunicorn_conf.py
+    app.run(host='0.0.0.0', port=5001, debug=os.getenv('FLASK_DEBUG') == '1')
@@ -1,21 +1,41 @@
 import sqlite3
 import os
-from datetime import datetime
+import re
+import atexit
+import threading
 
 DATA_DIR = os.environ.get('DATA_DIR', os.path.dirname(__file__))
 DB_PATH = os.path.join(DATA_DIR, 'sora_manager.db')
 PROXY_FILE = os.path.join(DATA_DIR, 'proxy.txt')
 
+_local = threading.local()
+
+# 裸代理格式 ip:port 或 ip:port:user:pass
+_PROXY_RE = re.compile(r'(?P<host>[^:/@\s]+):(?P<port>\d+)(?::(?P<user>[^:]+):(?P<pw>.+))?')
+
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    # SQLite 性能优化
-    conn.execute('PRAGMA journal_mode=WAL')
-    conn.execute('PRAGMA synchronous=NORMAL')
-    conn.execute('PRAGMA cache_size=10000')
-    conn.execute('PRAGMA temp_store=MEMORY')
+    """返回当前线程复用的连接；写操作用 `with conn:` 提交或回滚"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH)
+        conn.row_factory = sqlite3.Row
+        # SQLite 性能优化
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA cache_size=10000')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        _local.conn = conn
     return conn
 
+def close_db():
+    """关闭当前线程的连接（sqlite 连接只能由创建它的线程关闭）"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        _local.conn = None
+        conn.close()
+
+atexit.register(close_db)
+
 def init_db():
     """初始化数据库表"""
     conn = get_db()
@@ -60,9 +80,25 @@ def init_db():
             video_id TEXT,
             success INTEGER,
             error_msg TEXT,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            account_name TEXT,
+            proxy_url TEXT
         )
     ''')
+
+    # 旧库补充日志冗余列，并回填已有日志；
+    # 多个进程同时启动时先取写锁再检查，保证只迁移一次
+    with conn:
+        cursor.execute('BEGIN IMMEDIATE')
+        log_columns = {row[1] for row in cursor.execute('PRAGMA table_info(request_logs)')}
+        if 'account_name' not in log_columns:
+            cursor.execute('ALTER TABLE request_logs ADD COLUMN account_name TEXT')
+            cursor.execute('ALTER TABLE request_logs ADD COLUMN proxy_url TEXT')
+            cursor.execute('''
+                UPDATE request_logs SET
+                    account_name = (SELECT name FROM sora_accounts WHERE id = request_logs.account_id),
+                    proxy_url = (SELECT proxy_url FROM proxies WHERE id = request_logs.proxy_id)
+            ''')
     
     # 系统配置表
     cursor.execute('''
@@ -72,7 +108,12 @@ def init_db():
             updated_at TEXT DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    
+
+    # 索引：启用列表按最近使用排序、日志按时间倒序
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_accounts_enabled_used ON sora_accounts(enabled, last_used_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_proxies_enabled_used ON proxies(enabled, last_used_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_logs_created_at ON request_logs(created_at DESC)')
+
     # 初始化默认配置
     default_settings = [
         ('proxy_enabled', '0'),
@@ -81,43 +122,38 @@ def init_db():
         ('retry_on_403', '1'),
         ('max_retries', '3'),
         ('retry_delay', '2'),
+        ('rate_limit', '0'),
+        ('rate_limit_window', '60'),
     ]
     for key, value in default_settings:
         cursor.execute('INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)', (key, value))
     
     conn.commit()
-    conn.close()
 
 # ========== 账号管理 ==========
 def get_all_accounts():
     conn = get_db()
     accounts = conn.execute('SELECT * FROM sora_accounts ORDER BY id').fetchall()
-    conn.close()
     return [dict(a) for a in accounts]
 
 def get_enabled_accounts():
     conn = get_db()
     accounts = conn.execute('SELECT * FROM sora_accounts WHERE enabled=1 ORDER BY last_used_at ASC NULLS FIRST').fetchall()
-    conn.close()
     return [dict(a) for a in accounts]
 
 def get_account_by_id(account_id):
     conn = get_db()
     account = conn.execute('SELECT * FROM sora_accounts WHERE id=?', (account_id,)).fetchone()
-    conn.close()
     return dict(account) if account else None
 
 def add_account(name, access_token, refresh_token, client_id=None):
     conn = get_db()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO sora_accounts (name, access_token, refresh_token, client_id)
-        VALUES (?, ?, ?, ?)
-    ''', (name, access_token, refresh_token, client_id or 'app_OHnYmJt5u1XEdhDUx0ig1ziv'))
-    conn.commit()
-    account_id = cursor.lastrowid
-    conn.close()
-    return account_id
+    with conn:
+        cursor = conn.execute('''
+            INSERT INTO sora_accounts (name, access_token, refresh_token, client_id)
+            VALUES (?, ?, ?, ?)
+        ''', (name, access_token, refresh_token, client_id or 'app_OHnYmJt5u1XEdhDUx0ig1ziv'))
+    return cursor.lastrowid
 
 def update_account(account_id, **kwargs):
     conn = get_db()
@@ -128,56 +164,41 @@ def update_account(account_id, **kwargs):
             fields.append(f'{k}=?')
             values.append(v)
     if fields:
-        fields.append('updated_at=?')
-        values.append(datetime.now().isoformat())
+        fields.append('updated_at=CURRENT_TIMESTAMP')
         values.append(account_id)
-        conn.execute(f'UPDATE sora_accounts SET {",".join(fields)} WHERE id=?', values)
-        conn.commit()
-    conn.close()
+        with conn:
+            conn.execute(f'UPDATE sora_accounts SET {",".join(fields)} WHERE id=?', values)
 
 def delete_account(account_id):
     conn = get_db()
-    conn.execute('DELETE FROM sora_accounts WHERE id=?', (account_id,))
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute('DELETE FROM sora_accounts WHERE id=?', (account_id,))
 
-def update_account_usage(account_id, success=True, new_access_token=None, new_refresh_token=None):
+def update_account_tokens(account_id, access_token, refresh_token):
     conn = get_db()
-    now = datetime.now().isoformat()
-    if success:
-        conn.execute('UPDATE sora_accounts SET last_used_at=?, request_count=request_count+1 WHERE id=?', (now, account_id))
-    else:
-        conn.execute('UPDATE sora_accounts SET last_used_at=?, error_count=error_count+1 WHERE id=?', (now, account_id))
-    
-    if new_access_token and new_refresh_token:
-        conn.execute('UPDATE sora_accounts SET access_token=?, refresh_token=?, updated_at=? WHERE id=?',
-                     (new_access_token, new_refresh_token, now, account_id))
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute('UPDATE sora_accounts SET access_token=?, refresh_token=?, updated_at=CURRENT_TIMESTAMP WHERE id=?',
+                     (access_token, refresh_token, account_id))
 
 # ========== 代理管理 ==========
 def get_all_proxies():
     conn = get_db()
     proxies = conn.execute('SELECT * FROM proxies ORDER BY id').fetchall()
-    conn.close()
     return [dict(p) for p in proxies]
 
 def get_enabled_proxies():
     conn = get_db()
     proxies = conn.execute('SELECT * FROM proxies WHERE enabled=1 ORDER BY last_used_at ASC NULLS FIRST').fetchall()
-    conn.close()
     return [dict(p) for p in proxies]
 
 def add_proxy(proxy_url):
     conn = get_db()
     try:
-        conn.execute('INSERT INTO proxies (proxy_url) VALUES (?)', (proxy_url,))
-        conn.commit()
+        with conn:
+            conn.execute('INSERT INTO proxies (proxy_url) VALUES (?)', (proxy_url,))
         return True
     except sqlite3.IntegrityError:
         return False
-    finally:
-        conn.close()
 
 def update_proxy(proxy_id, **kwargs):
     conn = get_db()
@@ -189,58 +210,39 @@ def update_proxy(proxy_id, **kwargs):
             values.append(v)
     if fields:
         values.append(proxy_id)
-        conn.execute(f'UPDATE proxies SET {",".join(fields)} WHERE id=?', values)
-        conn.commit()
-    conn.close()
+        with conn:
+            conn.execute(f'UPDATE proxies SET {",".join(fields)} WHERE id=?', values)
 
 def delete_proxy(proxy_id):
     conn = get_db()
-    conn.execute('DELETE FROM proxies WHERE id=?', (proxy_id,))
-    conn.commit()
-    conn.close()
-
-def update_proxy_usage(proxy_id, success=True):
-    conn = get_db()
-    now = datetime.now().isoformat()
-    if success:
-        conn.execute('UPDATE proxies SET last_used_at=?, success_count=success_count+1 WHERE id=?', (now, proxy_id))
-    else:
-        conn.execute('UPDATE proxies SET last_used_at=?, fail_count=fail_count+1 WHERE id=?', (now, proxy_id))
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute('DELETE FROM proxies WHERE id=?', (proxy_id,))
 
 # ========== 设置管理 ==========
 def get_setting(key, default=None):
     conn = get_db()
     row = conn.execute('SELECT value FROM settings WHERE key=?', (key,)).fetchone()
-    conn.close()
     return row['value'] if row else default
 
 def get_all_settings():
     conn = get_db()
     rows = conn.execute('SELECT key, value FROM settings').fetchall()
-    conn.close()
     return {row['key']: row['value'] for row in rows}
 
+_UPSERT_SETTING = '''
+    INSERT INTO settings (key, value) VALUES (?, ?)
+    ON CONFLICT(key) DO UPDATE SET value=excluded.value, updated_at=CURRENT_TIMESTAMP
+'''
+
 def set_setting(key, value):
     conn = get_db()
-    conn.execute('''
-        INSERT INTO settings (key, value, updated_at) VALUES (?, ?, ?)
-        ON CONFLICT(key) DO UPDATE SET value=?, updated_at=?
-    ''', (key, value, datetime.now().isoformat(), value, datetime.now().isoformat()))
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute(_UPSERT_SETTING, (key, value))
 
 def set_settings(settings_dict):
     conn = get_db()
-    now = datetime.now().isoformat()
-    for key, value in settings_dict.items():
-        conn.execute('''
-            INSERT INTO settings (key, value, updated_at) VALUES (?, ?, ?)
-            ON CONFLICT(key) DO UPDATE SET value=?, updated_at=?
-        ''', (key, value, now, value, now))
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.executemany(_UPSERT_SETTING, [(key, value) for key, value in settings_dict.items()])
 
 # ========== 代理池文件 ==========
 def load_proxies_from_file():
@@ -248,7 +250,7 @@ def load_proxies_from_file():
     if not os.path.exists(PROXY_FILE):
         return 0
     
-    count = 0
+    rows = []
     with open(PROXY_FILE, 'r', encoding='utf-8') as f:
         for line in f:
             line = line.strip()
@@ -256,9 +258,14 @@ def load_proxies_from_file():
                 continue
             # 标准化代理格式
             proxy_url = normalize_proxy(line)
-            if proxy_url and add_proxy(proxy_url):
-                count += 1
-    return count
+            if proxy_url:
+                rows.append((proxy_url,))
+
+    # 单个事务批量插入，已存在的代理直接忽略
+    conn = get_db()
+    with conn:
+        cur = conn.executemany('INSERT OR IGNORE INTO proxies (proxy_url) VALUES (?)', rows)
+    return cur.rowcount
 
 def normalize_proxy(proxy_str):
     """标准化代理格式"""
@@ -270,37 +277,44 @@ def normalize_proxy(proxy_str):
     if proxy_str.startswith(('http://', 'https://', 'socks5://', 'socks4://')):
         return proxy_str
     
-    # ip:port 格式
-    if ':' in proxy_str:
-        parts = proxy_str.split(':')
-        if len(parts) == 2:
-            return f'http://{proxy_str}'
-        elif len(parts) == 4:
-            # ip:port:user:pass 格式
-            return f'http://{parts[2]}:{parts[3]}@{parts[0]}:{parts[1]}'
-    
-    return None
+    m = _PROXY_RE.fullmatch(proxy_str)
+    if not m:
+        return None
+    if m['user'] is None:
+        return f'http://{proxy_str}'
+    # ip:port:user:pass 格式
+    return f"http://{m['user']}:{m['pw']}@{m['host']}:{m['port']}"
 
 # ========== 日志 ==========
-def add_log(account_id, proxy_id, video_id, success, error_msg=None):
+def record_request_results(results):
+    """批量写入请求结果（账号/代理使用统计与请求日志），单个事务提交
+
+    results: [(account_id, account_name, proxy_id, proxy_url, video_id, success, error_msg), ...]
+    """
     conn = get_db()
-    conn.execute('''
-        INSERT INTO request_logs (account_id, proxy_id, video_id, success, error_msg)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (account_id, proxy_id, video_id, 1 if success else 0, error_msg))
-    conn.commit()
-    conn.close()
+    with conn:
+        # 直接获取写锁，整批只提交一次
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany(
+            'UPDATE sora_accounts SET last_used_at=CURRENT_TIMESTAMP, request_count=request_count+?, error_count=error_count+? WHERE id=?',
+            [(1 if success else 0, 0 if success else 1, account_id)
+             for account_id, _, _, _, _, success, _ in results]
+        )
+        conn.executemany(
+            'UPDATE proxies SET last_used_at=CURRENT_TIMESTAMP, success_count=success_count+?, fail_count=fail_count+? WHERE id=?',
+            [(1 if success else 0, 0 if success else 1, proxy_id)
+             for _, _, proxy_id, _, _, success, _ in results if proxy_id]
+        )
+        conn.executemany('''
+            INSERT INTO request_logs (account_id, account_name, proxy_id, proxy_url, video_id, success, error_msg)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [(account_id, account_name, proxy_id, proxy_url, video_id, 1 if success else 0, error_msg)
+              for account_id, account_name, proxy_id, proxy_url, video_id, success, error_msg in results])
 
 def get_recent_logs(limit=100):
     conn = get_db()
-    logs = conn.execute('''
-        SELECT l.*, a.name as account_name, p.proxy_url
-        FROM request_logs l
-        LEFT JOIN sora_accounts a ON l.account_id = a.id
-        LEFT JOIN proxies p ON l.proxy_id = p.id
-        ORDER BY l.created_at DESC LIMIT ?
-    ''', (limit,)).fetchall()
-    conn.close()
+    # 账号名与代理地址在写入时冗余保存，无需关联查询
+    logs = conn.execute('SELECT * FROM request_logs ORDER BY created_at DESC LIMIT ?', (limit,)).fetchall()
     return [dict(l) for l in logs]
 
 def get_stats():
@@ -308,7 +322,6 @@ def get_stats():
     conn = get_db()
     total = conn.execute('SELECT COUNT(*) as cnt FROM request_logs').fetchone()['cnt']
     success = conn.execute('SELECT COUNT(*) as cnt FROM request_logs WHERE success=1').fetchone()['cnt']
-    conn.close()
     return {'total': total, 'success': success}
 
 # 初始化
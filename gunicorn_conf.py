@@ -0,0 +1,19 @@
+# gunicorn 配置：gunicorn -c gunicorn_conf.py wsgi:app
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:5001')
+worker_class = 'gthread'
+# 请求以等待上游为主，并发靠线程；限流、熔断、缓存等状态按进程独立，进程数保持较小
+workers = int(os.getenv('GUNICORN_WORKERS', 2))
+threads = int(os.getenv('GUNICORN_THREADS', 16))
+# 长连接保持时间需大于前置负载均衡的空闲超时
+keepalive = 65
+# 单次解析含重试最长可达数十秒
+timeout = 180
+
+
+def on_starting(server):
+    """在 master 中完成建表与迁移，避免多个 worker 同时迁移旧库"""
+    import database
+    # 连接不能跨 fork 共享，worker 会各自重新打开
+    database.close_db()
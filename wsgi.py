@@ -0,0 +1,5 @@
+# 生产环境入口：gunicorn -c gunicorn_conf.py wsgi:app
+# app.py 中的 app.run() 仅用于本地开发
+from app import app
+
+__all__ = ['app']